@@ -122,9 +122,9 @@ class SpectrometerWindow(QMainWindow):
     def update_spectrum(self):
         self.data_stack.append(self.worker.get_spectrum())
 
-        for i in xrange(len(self.data_stack)):
+        for i in range(len(self.data_stack)):
             d = self.data_stack[i]   
-            if d != None: 
+            if d is not None: 
                 log.debug('plotting curve %d', i)
                 if i == len(self.data_stack)-1:
                     self.curves[i].setPen(color=(0, 255, 0, 255))
@@ -135,7 +135,7 @@ class SpectrometerWindow(QMainWindow):
     def update_temp(self):
         res = self.worker.get_temp()
 
-        if res != None:
+        if res is not None:
             self.spec_temp_lb.setText("value")
 
     def change_integration_time(self):
@@ -151,7 +151,7 @@ class SpectrometerWindow(QMainWindow):
         # add new curves
         val = self.persistence_sb.value()
 
-        for i in xrange(val): 
+        for i in range(val): 
             log.info('added %d item', i)
             self.curves.append(self.plot.plot())
 
@@ -248,5 +248,5 @@ try:
     ex.show()
     app.exec_()
 except RuntimeError as e:
-    print e
+    print(e)
 
@@ -1,14 +1,17 @@
+import array
+import collections
 import logging
 import usb.core
 import usb.util
 import struct
+import threading
 import numpy 
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 log = logging.getLogger('oceanoptics.hardware')
 
 log.setLevel(logging.INFO)
-__all__ = ['USB4000']
+__all__ = ['USB4000', 'Status']
 
 commands = { \
     0x01: ('init', 'initialize USB4000'), 
@@ -59,26 +62,69 @@ config_regs = {\
     18: 'baud_rate' \
 }   
 
+# precompiled command and response layouts
+_S_CMD1 = struct.Struct('<B')
+_S_CMD2 = struct.Struct('<2B')
+_S_SET_I = struct.Struct('<BI')
+_S_TRIG = struct.Struct('<BH')
+# single values are unpacked in place with these as well, slicing for int.from_bytes is slower
+_S_TEMP = struct.Struct('<h')
+_S_FW = struct.Struct('>H')
+_S_STATUS = struct.Struct('<HIBBBBBB')
+
+Status = collections.namedtuple('Status', 'num_pixels integration_time lamp_enable trigger_mode '
+                                           'acq_status packets_in_spectra power_down packet_count '
+                                           'usb_speed')
+
+# fixed command packets
+_INIT_CMD = _S_CMD1.pack(0x01)
+_SPEC_CMD = _S_CMD1.pack(0x09)
+_FW_CMD = _S_CMD2.pack(0x6B, 0x04)
+_TEMP_CMD = _S_CMD1.pack(0x6C)
+_STATUS_CMD = _S_CMD1.pack(0xFE)
+_CONFIG_CMDS = tuple(_S_CMD2.pack(0x05, x) for x in range(19))
+
+# the PCB temperature is reported in units of 1/256 degrees C
+_TEMP_SCALE = 1.0 / 256.0
+
+# timeout in ms when discarding the rest of a failed spectrum, whatever is left is already
+# queued on the endpoints so there is no need to wait for the integration time
+_DRAIN_TIMEOUT = 10
+
+# layout of a single 64 byte configuration response
+_CONFIG_DTYPE = numpy.dtype([('echo', 'u1'), ('reg', 'u1'), ('payload', 'S62')])
+_CONFIG_REGS = numpy.arange(19, dtype='u1')
+
 class USB4000(object):
     '''Class representing Ocean Optics spectrometer'''
     
+    __slots__ = ('_device', '_cmd_w', '_cmd_r', '_spec_hi', '_spec_lo',
+                 '_spec_lo_buf', '_spec_hi_buf', '_spec_pixels',
+                 '_rbuf64', '_rbuf16', '_rbuf3', '_config_cache',
+                 'dataCallback', '_spectra', '_stream', '_stream_active', '_spec_timeout')
+    
     idVendor = 0x2457
     idProduct = 0x1022
     
-    def __new__(cls, id=0):
+    def __new__(cls, id=0, reset=False):
         avail = usb.core.find(idVendor=cls.idVendor, idProduct=cls.idProduct)
 
         if avail is None:
             raise RuntimeError('no ocean optics devices found')
         
         if isinstance(avail, list):
-            print 'Got {:d} devices, taking {:d}'.format(len(avail), id)
+            print('Got {:d} devices, taking {:d}'.format(len(avail), id))
             avail = avail[id]
-        obj = super(USB4000, cls).__new__(cls)
+        obj = super().__new__(cls)
         obj._device = avail
         return obj
     
-    def __init__(self):
+    def __init__(self, id=0, reset=False):
+        '''opens the spectrometer
+        
+        The device is only reset when `reset` is set. A reset re-enumerates the device, which
+        takes a long time and is not needed when the previous session was closed cleanly.
+        '''
         log.debug('In init!')
         
         try:
@@ -89,10 +135,16 @@ class USB4000(object):
                 
         try:
             self._device.set_configuration() # There is only one configuration
-            #self._device.reset()
         except usb.core.USBError as e:
             log.fatal("could not set configuration")
             raise RuntimeError('failed to set configuration')
+        
+        if reset:
+            try:
+                self.reset()
+            except usb.core.USBError as e:
+                log.fatal("could not reset device")
+                raise RuntimeError('failed to reset device')
             
         cfg = self._device.get_active_configuration()
         
@@ -101,6 +153,32 @@ class USB4000(object):
         self._spec_lo = usb.util.find_descriptor(cfg[(0,0)], bEndpointAddress=0x86)
         self._cmd_r = usb.util.find_descriptor(cfg[(0,0)], bEndpointAddress=0x81)
         
+        # spectra are read in place into these buffers. The numpy views share their memory and are
+        # overwritten by the next read, so anything handed out to callers has to be copied first.
+        self._spec_lo_buf = array.array('B', b'\x00' * 512*4)
+        # The sync byte arrives as a short packet, which ends the bulk transfer, and every spectrum
+        # needs its own request, so a read can never span more than one spectrum.
+        self._spec_hi_buf = array.array('B', b'\x00' * (512*11 + 1)) # trailing sync byte
+        # pixels 10 to 1023 arrive on the low endpoint, 1024 to 3649 on the high endpoint
+        self._spec_pixels = (numpy.frombuffer(self._spec_lo_buf, dtype='<u2', offset=20),
+                             numpy.frombuffer(self._spec_hi_buf, dtype='<u2', count=2626))
+        # read timeout in ms for the spectrum endpoints, follows the integration time
+        self._spec_timeout = 100
+        
+        # command responses are read in place as well and are only valid until the next command
+        self._rbuf64 = array.array('B', b'\x00' * 64)
+        self._rbuf16 = array.array('B', b'\x00' * 16)
+        self._rbuf3 = array.array('B', b'\x00' * 3)
+        
+        # configuration registers do not change while the device is connected
+        self._config_cache = None
+        
+        # continuous acquisition, see `start`. Only the latest 100 spectra are kept for `poll`.
+        self.dataCallback = None
+        self._spectra = collections.deque(maxlen=100)
+        self._stream = None
+        self._stream_active = threading.Event()
+        
         # initialize spectrometer
         self.init()
         
@@ -110,7 +188,7 @@ class USB4000(object):
         This command initializes certain parameters on the USB4000 and sets internal variables
         based on the USB communication speed. This command is called at object instantiation.
         '''
-        self._cmd_w.write(struct.pack('<B', 0x01))
+        self._cmd_w.write(_INIT_CMD)
         
     def set_integration_time(self, dt):
         '''sets the integration time to use by the spectrometer in microseconds
@@ -128,72 +206,109 @@ class USB4000(object):
                 log.warning('integration time {:d} too high, setting to maximum of 65,535,000 us'.format(dt))
                 dt = 65535000 # can't integrate for less than 10 us
                 
-            cmd = struct.pack('<BI', 0x02, dt)
+            cmd = _S_SET_I.pack(0x02, dt)
             log.debug('Sending {:s}'.format(repr(cmd)))
-            return self._cmd_w.write(cmd)
+            ret = self._cmd_w.write(cmd)
+            self._spec_timeout = 100 + dt // 1000
+            return ret
         
         log.info('wrong type of data in set_integration_time, {}'.format(type(dt)))
         
-    def query_config(self):
-        '''returns the value stored in register `reg` of the spectrometer
+    def query_config(self, refresh=False):
+        '''returns the values stored in the configuration registers of the spectrometer
+        
+        The registers are only read from the device on the first call, later calls return the
+        cached values unless `refresh` is set.
         '''
+        if not refresh and self._config_cache is not None:
+            return dict(self._config_cache)
+        
         log.info('getting configuration parameters')
         
-        config = {}
+        # responses are collected back to back and decoded afterwards, keeping
+        # the round trips to the device as short as possible
+        block = bytearray(19*64)
+        resp = memoryview(self._rbuf64)
         
-        for x in xrange(19):
-            cmd = struct.pack('<2B', 0x05, x)
-            log.debug('Sending {:s}'.format(repr(cmd)))
-            self._cmd_w.write(cmd)
-            resp = bytearray(self._cmd_r.read(64, timeout=1000))
-            log.debug('config {:d} is {:s}'.format(x, repr(resp)))
-            
-            assert resp[0:2] == bytearray([0x05, x]) # Check that proper echo is returned
-            
-            log.info('{:s} : {:s}'.format(config_regs[x], resp[2:].decode('ascii', errors='ignore')))
-            config.update({config_regs[x] : resp[2:].decode('ascii', errors='ignore').strip('\x00')})
-            
-        return config
+        for x, cmd in enumerate(_CONFIG_CMDS):
+            n = self._query(cmd, self._rbuf64)
+            block[64*x:64*x + n] = resp[:n]
+        
+        rows = numpy.frombuffer(block, dtype=_CONFIG_DTYPE)
+        
+        # Check that proper echo is returned
+        assert (rows['echo'] == 0x05).all() and (rows['reg'] == _CONFIG_REGS).all()
+        
+        # trailing padding is already dropped by the 'S62' field
+        values = numpy.char.decode(rows['payload'], 'ascii', 'ignore').tolist()
+        config = dict((config_regs[x], value.strip('\x00')) for x, value in enumerate(values))
+        
+        for x in range(19):
+            log.info('{:s} : {:s}'.format(config_regs[x], config[config_regs[x]]))
+        
+        self._config_cache = config
+        return dict(config)
             
     def reset(self):
         log.debug('resetting device')
         self._device.reset()
     
-    def read_temp(self):
-        log.debug('getting pcb temperature')
-        cmd = struct.pack('<B', 0x6C)
-        self._cmd_w.write(cmd)
+    def _query(self, cmd, buf, timeout=1000):
+        '''sends command `cmd` and reads the response in place into `buf`
         
-        log.debug('sending {:s}'.format(repr(cmd)))
+        Returns the number of bytes read. Every command that expects an answer goes through here,
+        so the debug output is only formatted when it is actually going to be emitted.
+        '''
+        self._cmd_w.write(cmd)
+        n = self._cmd_r.read(buf, timeout=timeout)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('sent {:s}, got {:s}'.format(repr(cmd), repr(buf[:n])))
+        return n
+    
+    def _read_temp_raw(self):
+        n = self._query(_TEMP_CMD, self._rbuf3)
+        resp = self._rbuf3
         
-        resp = bytearray(self._cmd_r.read(3, timeout=1000))
-        log.debug('got {:s}'.format(repr(resp)))
+        assert n == len(resp) # Check that the full response is returned
+        assert resp[0] == 0x08 # Check that proper echo is returned
         
-        assert resp[0:1] == bytearray([0x08]) # Check that proper echo is returned
+        return _S_TEMP.unpack_from(resp, 1)[0]
+    
+    def read_temp(self):
+        '''returns the PCB temperature in degrees C
         
-        t = struct.unpack('<h', resp[1:3])[0]
-        log.debug('temperature is {}'.format(t*0.003906))
-        return t*0.003906
+        The spectrometer reports a signed 16 bit value with an LSB of 1/256 degrees C, the datasheet
+        rounds this to 0.003906.
+        '''
+        log.debug('getting pcb temperature')
+        t = self._read_temp_raw()*_TEMP_SCALE
+        log.debug('temperature is {}'.format(t))
+        return t
+    
+    def read_temps(self, n):
+        '''reads the PCB temperature `n` times in a row and returns the readings in degrees C'''
+        log.debug('getting {:d} pcb temperatures'.format(n))
+        raw = numpy.empty(shape=(n,), dtype='int16')
+        for i in range(n):
+            raw[i] = self._read_temp_raw()
+        return raw*_TEMP_SCALE
     
     def firmware_version(self):
         log.debug('getting firmware version')
-        cmd = struct.pack('<2B', 0x6B, 0x04)
-        log.debug('sending {:s}'.format(repr(cmd)))
-        self._cmd_w.write(cmd)
-        
-        resp = bytearray(self._cmd_r.read(3, timeout=200))
-        log.debug('got {:s}'.format(repr(resp)))
+        n = self._query(_FW_CMD, self._rbuf3, timeout=200)
+        resp = self._rbuf3
         
-        assert resp[0:1] == bytearray([0x04]) # Check that proper echo is returned
+        assert n == len(resp) # Check that the full response is returned
+        assert resp[0] == 0x04 # Check that proper echo is returned
         
-        vers = struct.unpack('>H', resp[1:3])[0]
+        vers = _S_FW.unpack_from(resp, 1)[0]
         log.info('firmware is {:d}'.format(vers))
         return vers
     
     def set_trigger_mode(self, mode=0):
         log.debug('setting {} for the trigger mode'.format(repr(mode)))
         if isinstance(mode, int):
-            cmd = struct.pack('<BH', 0x0A, mode)
+            cmd = _S_TRIG.pack(0x0A, mode)
             log.debug('Sending {:s}'.format(repr(cmd)))
             return self._cmd_w.write(cmd)
         
@@ -216,56 +331,165 @@ class USB4000(object):
 
       
     def request_spectra(self):
-        cmd = struct.pack('<B', 0x09)
+        '''requests a spectrum and waits for it to be read out'''
+        self.request_spectra_async()
+        return self.poll_spectrum()
+    
+    def request_spectra_async(self):
+        '''sends the spectrum request without waiting for the data
+        
+        The spectrometer starts acquiring as soon as the request arrives, so the caller can process
+        the previous spectrum while the next one is integrating and collect it with `poll_spectrum`.
+        '''
         log.debug('Requesting spectra')
-        log.debug('Sending {:s}'.format(repr(cmd)))
-        self._cmd_w.write(cmd)
+        self._cmd_w.write(_SPEC_CMD)
+        
+    def poll_spectrum(self):
+        '''reads out the spectrum requested by `request_spectra_async`
         
-        data = numpy.zeros(shape=(3840,), dtype='uint16')
+        The returned array is a copy, it stays valid when the next spectrum is read. If the
+        readout fails, the rest of the spectrum is discarded and an all-zero array is returned.
+        '''
+        # only pixels 10 to 3650 are returned, the rest are dark or unused
+        data = numpy.zeros(shape=(3640,), dtype='uint16')
         
         try:
-            data_lo = self._spec_lo.read(512*4, timeout=100)
-            data_hi = self._spec_hi.read(512*11, timeout=100)
-
-            data_sync = self._spec_hi.read(1, timeout=100)
-
-            assert struct.unpack('<B', data_sync)[0] == 0x69
-
-            data[:1024], data[1024:] =  numpy.frombuffer(data_lo, dtype='uint16'), \
-                                        numpy.frombuffer(data_hi, dtype='uint16')
+            self._read_spectrum()
+            numpy.concatenate(self._spec_pixels, out=data)
         except AssertionError:
             log.error('not synchronized')
+            self._drain()
         except usb.core.USBError:
             log.error('timeout on usb')
+            self._drain()
         finally:
             log.debug('obtained spectra')
 
-        return data[10:3650]
+        return data
+    
+    def _read_spectrum(self):
+        '''reads the outstanding spectrum into the spectrum buffers
+        
+        Raises `usb.core.USBError` on a timeout and `AssertionError` when the readout is out of
+        sync, in both cases the rest of the spectrum may still be pending on the endpoints.
+        '''
+        n = self._spec_lo.read(self._spec_lo_buf, timeout=self._spec_timeout)
+        assert n == 512*4
+        
+        # the sync byte follows the last packet, so it is read in the same transfer
+        n = self._spec_hi.read(self._spec_hi_buf, timeout=self._spec_timeout)
+        assert n == 512*11 + 1 and self._spec_hi_buf[-1] == 0x69
+    
+    def _drain(self):
+        '''discards whatever is left of the outstanding spectrum on the data endpoints'''
+        for ep, buf in ((self._spec_lo, self._spec_lo_buf), (self._spec_hi, self._spec_hi_buf)):
+            try:
+                for _ in range(2):
+                    if not ep.read(buf, timeout=_DRAIN_TIMEOUT):
+                        break
+            except usb.core.USBError:
+                pass
+    
+    def start(self):
+        '''starts continuous acquisition in a background thread
+        
+        Every spectrum is passed to `dataCallback` if it is set, otherwise it is queued for `poll`.
+        The queue holds the latest 100 spectra, older ones are dropped when it is not polled often
+        enough. The next spectrum is requested before the current one is handed on, so the
+        spectrometer integrates while the callback runs. No other commands should be sent until
+        `stop`. `stop` may be called from `dataCallback`, `close` may not.
+        '''
+        if self._stream is not None and self._stream.is_alive():
+            log.warning('acquisition already running')
+            return
+        
+        log.debug('starting acquisition')
+        self._stream_active.set()
+        self._stream = threading.Thread(target=self._acquire)
+        self._stream.daemon = True
+        self._stream.start()
+        
+    def stop(self):
+        '''stops continuous acquisition after the outstanding spectrum has been read
+        
+        When called from `dataCallback` this only signals the acquisition thread, which ends once
+        the callback returns.
+        '''
+        if self._stream is None:
+            return
+        
+        log.debug('stopping acquisition')
+        self._stream_active.clear()
+        if threading.current_thread() is self._stream:
+            return
+        self._stream.join()
+        self._stream = None
+        
+    def poll(self):
+        '''returns the oldest spectrum queued by continuous acquisition, or None if there is none
+        
+        Only the latest 100 spectra are queued, older ones are dropped.
+        '''
+        try:
+            return self._spectra.popleft()
+        except IndexError:
+            return None
+        
+    def _acquire(self):
+        try:
+            self.request_spectra_async()
+            while True:
+                try:
+                    self._read_spectrum()
+                except (AssertionError, usb.core.USBError) as e:
+                    # drop the spectrum and only request a new one once nothing is outstanding,
+                    # otherwise every later readout would belong to the previous request
+                    log.error('lost spectrum, resynchronizing')
+                    log.error(repr(e))
+                    self._drain()
+                    if not self._stream_active.is_set():
+                        break
+                    self.request_spectra_async()
+                    continue
+                
+                data = numpy.concatenate(self._spec_pixels)
+                active = self._stream_active.is_set()
+                if active:
+                    self.request_spectra_async()
+                
+                if self.dataCallback is not None:
+                    try:
+                        self.dataCallback(data)
+                    except Exception as e:
+                        log.error('data callback failed')
+                        log.error(repr(e))
+                else:
+                    self._spectra.append(data)
+                
+                if not active:
+                    break
+        except usb.core.USBError as e:
+            log.error('acquisition stopped')
+            log.error(repr(e))
+        finally:
+            self._stream_active.clear()
 
     def get_status(self):
         log.debug('getting status parameters')
         
-        cmd = struct.pack('<B', 0xFE)
-        log.debug('Sending {:s}'.format(repr(cmd)))
-        self._cmd_w.write(cmd)
-        resp = bytearray(self._cmd_r.read(16, timeout=1000))
-        log.debug('status is {:s}'.format(repr(resp)))
-        
-        stat = {\
-            'num_pixels' : struct.unpack('<H', resp[0:2])[0],
-            'integration_time' : struct.unpack('<I', resp[2:6])[0],
-            'lamp_enable': bool(struct.unpack('<B', resp[6:7])[0]),
-            'trigger_mode' : struct.unpack('<B', resp[7:8])[0],
-            'acq_status' : struct.unpack('<B', resp[8:9])[0],
-            'packets_in_spectra' : struct.unpack('<B', resp[9:10])[0],
-            'power_down' : bool(struct.unpack('<B', resp[10:11])[0]),
-            'packet_count' : struct.unpack('<B', resp[11:12])[0],
-            'usb_speed' : struct.unpack('<B', resp[14:15])[0]
-        }
-        
-        return stat
+        n = self._query(_STATUS_CMD, self._rbuf16)
+        resp = self._rbuf16
+        
+        assert n == len(resp) # Check that the full response is returned
+        
+        num_pixels, integration_time, lamp_enable, trigger_mode, acq_status, \
+            packets_in_spectra, power_down, packet_count = _S_STATUS.unpack_from(resp, 0)
+        
+        return Status(num_pixels, integration_time, bool(lamp_enable), trigger_mode, acq_status,
+                      packets_in_spectra, bool(power_down), packet_count, resp[14])
         
     def close(self):
+        self.stop()
         usb.util.dispose_resources(self._device)
         
     status = property(lambda self: self.get_status())